@@ -1,16 +1,49 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
 from dotenv import load_dotenv
+import asyncio
+import logging
 import os
+import time
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 # Load env variables
 load_dotenv()
 
 DB_URL = os.getenv("DATABASE_URL")
+# Optional asyncpg URL; otherwise derived from DATABASE_URL
+ASYNC_DB_URL = os.getenv("ASYNC_DATABASE_URL")
 TABLE_NAME = "grants"
-engine = create_engine(DB_URL)
+META_TABLE = "grants_meta"
+# How long a payload is reused when no upload time has been recorded yet
+UNVERSIONED_CACHE_TTL = 60
+# libpq URL options with an asyncpg equivalent; anything else is dropped
+LIBPQ_TO_ASYNCPG_OPTIONS = {"sslmode": "ssl", "connect_timeout": "timeout"}
+ASYNCPG_OPTIONS = {"ssl", "timeout", "command_timeout", "prepared_statement_cache_size"}
+
+def to_async_url(url):
+    url = make_url(url)
+    query = {}
+    for key, value in url.query.items():
+        key = LIBPQ_TO_ASYNCPG_OPTIONS.get(key, key)
+        if key in ASYNCPG_OPTIONS:
+            query[key] = value
+        else:
+            logger.warning("Ignoring database URL option %r not supported by asyncpg", key)
+    return url.set(drivername="postgresql+asyncpg", query=query)
+
+# asyncpg keeps DB I/O on the event loop instead of tying up threadpool workers
+engine = create_async_engine(ASYNC_DB_URL or to_async_url(DB_URL))
+
+# Serialized /grants payload, reused until the uploader records a newer upload
+_cache = {"version": None, "payload": None, "built_at": 0.0}
+_cache_lock = asyncio.Lock()
 
 app = FastAPI()
 
@@ -22,8 +55,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+async def dispose_engine():
+    await engine.dispose()
+
+async def get_table_version():
+    async with engine.connect() as conn:
+        try:
+            result = await conn.execute(text(f"SELECT updated_at FROM {META_TABLE};"))
+            return result.scalar()
+        except DBAPIError:
+            # No upload recorded yet
+            return None
+
+def cache_is_fresh(version):
+    if _cache["payload"] is None:
+        return False
+    if version is None:
+        # Without an upload time, fall back to a short TTL so requests don't rebuild back to back
+        return _cache["version"] is None and time.monotonic() - _cache["built_at"] < UNVERSIONED_CACHE_TTL
+    return version == _cache["version"]
+
+def serialize_rows(rows, columns):
+    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+    return df.to_json(orient="records", date_format="iso")
+
+async def rebuild_payload(version):
+    async with engine.connect() as conn:
+        result = await conn.execute(text(f"SELECT * FROM {TABLE_NAME};"))
+        columns = list(result.keys())
+        rows = result.fetchall()
+    # Building and encoding the whole table is CPU-bound; keep it off the event loop
+    _cache["payload"] = await asyncio.to_thread(serialize_rows, rows, columns)
+    _cache["version"] = version
+    _cache["built_at"] = time.monotonic()
+
 @app.get("/grants")
-def get_grants():
-    with engine.connect() as conn:
-        df = pd.read_sql_table(TABLE_NAME, conn)
-        return df.to_dict(orient="records")
\ No newline at end of file
+async def get_grants():
+    # The version check releases its connection before any request waits on the lock
+    version = await get_table_version()
+    if not cache_is_fresh(version):
+        # Only one request rebuilds a stale payload; the rest wait and reuse it
+        async with _cache_lock:
+            if not cache_is_fresh(version):
+                await rebuild_payload(version)
+    return Response(content=_cache["payload"], media_type="application/json")
\ No newline at end of file
@@ -1,21 +1,33 @@
 import os
+import io
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import hashlib
+import xxhash
 import logging
 import torch
 import time
 from datetime import datetime
+from functools import partial
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
 from sqlalchemy import create_engine, text
-from datasets import Dataset
 from transformers import (
     AutoTokenizer,
-    AutoModelForSequenceClassification,
-    TextClassificationPipeline
+    AutoModelForSequenceClassification
 )
+from torch.utils.data import DataLoader, Dataset as TorchDataset
 import dotenv
 
 dotenv.load_dotenv()
 
+# The inference DataLoader forks workers after the fast tokenizer has run in this
+# process; its Rust thread pool must not be live across that fork.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
 # === Logging Setup ===
 log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
 log_file_handler = logging.FileHandler("logs/uploader.log")
@@ -35,22 +47,158 @@ CSV_FILE_PATH = 'pulled_grants.csv'
 DATABASE_URL = os.getenv("DATABASE_URL")
 TABLE_NAME = "grants"
 HASH_TABLE = "grants_hashes"
+META_TABLE = "grants_meta"
+STAGE_TABLE = "grants_hashes_stage"
 TEXT_COLUMNS = ['Recipient', 'Agreement', 'Description']
 MODEL_DIR = "./classifier"
 LABELS_FILE = "./classifier/label_encoder_classes.txt"
+ONNX_MODEL_DIR = "./classifier_onnx"
+ONNX_QUANTIZED_FILE = "model_quantized.onnx"
+# Records which ./classifier files the cached ONNX export was built from
+ONNX_SOURCE_FILE = "source_fingerprint.txt"
+BATCH_SIZE = 32
+# Compiled GPU batches are padded to this length (~99th percentile of grant texts) so one graph serves every batch
+MAX_SEQ_LENGTH = 256
+# DataLoader workers that tokenize upcoming batches while the model runs
+NUM_WORKERS = 2
+UPLOAD_CHUNK_SIZE = 1000
+# "pandas" (vectorized, default), "xxh3" or "sha256" when cryptographic hashes are required.
+# Every algorithm is truncated to 64 bits and stored as a signed BIGINT.
+HASH_ALGORITHM = os.getenv("HASH_ALGORITHM", "pandas")
+ROW_HASHERS = {
+    "xxh3": lambda data: xxhash.xxh3_128(data).digest(),
+    "sha256": lambda data: hashlib.sha256(data).digest(),
+}
+# SHA-256 inputs at least this large are hashed across a forked process pool
+PARALLEL_HASH_MIN_ROWS = 100_000
 
-def hash_row(row):
-    row_str = '|'.join(str(v) for v in row)
-    return hashlib.sha256(row_str.encode()).hexdigest()
+# Frame shared with forked hashing workers, which inherit it copy-on-write instead of unpickling it
+_hash_source = None
 
-def load_pipeline():
-    logger.info("Loading model and tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR)
-    model = AutoModelForSequenceClassification.from_pretrained(
+def arrow_strings(df, columns):
+    return [pc.fill_null(pc.cast(pa.array(df[c]), pa.string()), '') for c in columns]
+
+def join_row_bytes(df):
+    # One Arrow kernel builds each row's '|'-joined buffer, so hashing does no per-row string work
+    joined = pc.binary_join_element_wise(*arrow_strings(df, df.columns), '|')
+    return pc.cast(joined, pa.binary()).to_pylist()
+
+def hash_bytes(data, algorithm="xxh3"):
+    digest = ROW_HASHERS[algorithm](data)
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+def hash_frame(df, algorithm):
+    return np.fromiter(
+        (hash_bytes(data, algorithm) for data in join_row_bytes(df)),
+        dtype=np.int64, count=len(df)
+    )
+
+def hash_row_range(bounds, algorithm):
+    lo, hi = bounds
+    return hash_frame(_hash_source.iloc[lo:hi], algorithm)
+
+def hash_frame_parallel(df, algorithm, n_workers):
+    global _hash_source
+    bounds = np.linspace(0, len(df), n_workers + 1, dtype=int)
+    _hash_source = df
+    try:
+        # Workers get only row bounds and return one int64 array each. fork is safe here
+        # because main() hashes before any CUDA context, model or tokenizer exists.
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("fork")) as pool:
+            parts = pool.map(hash_row_range, zip(bounds[:-1], bounds[1:]), repeat(algorithm))
+            return np.concatenate(list(parts))
+    finally:
+        _hash_source = None
+
+def hash_rows(df):
+    if HASH_ALGORITHM in ROW_HASHERS:
+        n_workers = os.cpu_count() or 1
+        if (HASH_ALGORITHM == "sha256" and n_workers > 1 and len(df) >= PARALLEL_HASH_MIN_ROWS
+                and "fork" in get_all_start_methods()):
+            hashes = hash_frame_parallel(df, HASH_ALGORITHM, n_workers)
+        else:
+            hashes = hash_frame(df, HASH_ALGORITHM)
+        return pd.Series(hashes, index=df.index)
+    # Dedup only needs collision resistance, so hash all columns at once in C
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    return pd.Series(hashes.to_numpy().view('int64'), index=df.index)
+
+class TextDataset(TorchDataset):
+    # Raw strings; the DataLoader tokenizes them in its worker processes
+    def __init__(self, texts):
+        self.texts = texts
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        return self.texts[i]
+
+def load_torch_model():
+    return AutoModelForSequenceClassification.from_pretrained(
         MODEL_DIR,
         local_files_only=True,
         trust_remote_code=True
     )
+
+def model_fingerprint(model_dir):
+    # Name, size and mtime of every file is enough to notice a retrained or replaced model
+    entries = sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(model_dir) if entry.is_file()
+    )
+    return hashlib.sha256(repr(entries).encode()).hexdigest()
+
+def load_onnx_model():
+    # Export and quantize once per source model; later runs load the cached INT8 model directly
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = os.path.join(ONNX_MODEL_DIR, ONNX_QUANTIZED_FILE)
+    source_path = os.path.join(ONNX_MODEL_DIR, ONNX_SOURCE_FILE)
+    fingerprint = model_fingerprint(MODEL_DIR)
+    cached_fingerprint = None
+    if os.path.exists(source_path):
+        with open(source_path) as f:
+            cached_fingerprint = f.read().strip()
+
+    if not os.path.exists(quantized_path) or cached_fingerprint != fingerprint:
+        logger.info(f"Exporting classifier to ONNX: {ONNX_MODEL_DIR}")
+        ort_model = ORTModelForSequenceClassification.from_pretrained(
+            MODEL_DIR,
+            export=True,
+            local_files_only=True
+        )
+        ort_model.save_pretrained(ONNX_MODEL_DIR)
+        logger.info(f"Quantizing ONNX model to INT8: {quantized_path}")
+        quantize_dynamic(
+            os.path.join(ONNX_MODEL_DIR, "model.onnx"),
+            quantized_path,
+            weight_type=QuantType.QInt8
+        )
+        with open(source_path, "w") as f:
+            f.write(fingerprint)
+    return ORTModelForSequenceClassification.from_pretrained(
+        ONNX_MODEL_DIR,
+        file_name=ONNX_QUANTIZED_FILE
+    )
+
+def load_classifier():
+    logger.info("Loading model and tokenizer...")
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR, use_fast=True)
+    use_cuda = torch.cuda.is_available()
+    if use_cuda:
+        model = load_torch_model()
+    else:
+        try:
+            model = load_onnx_model()
+        except ImportError as e:
+            logger.warning(f"ONNX Runtime path unavailable ({e}); falling back to PyTorch on CPU.")
+            model = load_torch_model()
+        except Exception:
+            logger.warning("ONNX export or load failed; falling back to PyTorch on CPU.", exc_info=True)
+            model = load_torch_model()
+
     with open(LABELS_FILE) as f:
         labels = [line.strip() for line in f if line.strip()]
     id2label = {i: label for i, label in enumerate(labels)}
@@ -58,68 +206,183 @@ def load_pipeline():
     model.config.id2label = id2label
     model.config.label2id = label2id
 
-    pipe = TextClassificationPipeline(
-        model=model,
-        tokenizer=tokenizer,
-        return_all_scores=False,
-        device=0 if torch.cuda.is_available() else -1
+    if use_cuda:
+        # Half precision halves memory traffic; compiling with CUDA graphs removes launch overhead
+        model = model.to(torch.float16).to("cuda").eval()
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+        # Pay the one-off compilation cost up front rather than on the first real batch
+        logger.info("Warming up compiled model...")
+        start = time.time()
+        encoded, _ = collate_batch(["warm-up"], tokenizer, fixed_shape=True)
+        # CUDA graphs are recorded after a few warm-up iterations
+        for _ in range(3):
+            forward_batch(model, encoded)
+        logger.info(f"Warm-up finished in {time.time() - start:.2f} seconds.")
+    return model, tokenizer
+
+def collate_batch(texts, tokenizer, fixed_shape):
+    n = len(texts)
+    if fixed_shape:
+        # Constant (BATCH_SIZE, MAX_SEQ_LENGTH) inputs let the compiled graph be reused as-is
+        texts = texts + [""] * (BATCH_SIZE - n)
+        shape_kwargs = {"padding": "max_length", "max_length": MAX_SEQ_LENGTH}
+    else:
+        # Dynamic padding; truncation falls back to tokenizer.model_max_length
+        shape_kwargs = {"padding": True}
+    encoded = tokenizer(
+        texts,
+        truncation=True,
+        return_tensors="pt",
+        **shape_kwargs
     )
-    return pipe
+    return encoded, n
+
+@torch.inference_mode()
+def forward_batch(model, encoded):
+    if torch.cuda.is_available():
+        encoded = {k: v.to("cuda", non_blocking=True) for k, v in encoded.items()}
+    logits = model(**encoded).logits
+    scores, label_ids = torch.softmax(logits.float(), dim=-1).max(dim=-1)
+    return label_ids.cpu().numpy(), scores.cpu().numpy()
 
-def add_predictions(df, pipeline):
+def build_texts(df):
+    # Join the text columns with Arrow kernels instead of copying every cell through astype(str)
+    return pc.binary_join_element_wise(*arrow_strings(df, TEXT_COLUMNS), ' ')
+
+def add_predictions(df, model, tokenizer):
     logger.info("Running inference...")
-    df['text'] = df[TEXT_COLUMNS].fillna('').astype(str).agg(' '.join, axis=1)
-    hf_dataset = Dataset.from_pandas(df[['text']])
-    texts = list(hf_dataset['text'])
-    results = pipeline(texts)
-    df['predicted_label'] = [r['label'] for r in results]
-    df['predicted_score'] = [r['score'] for r in results]
-    return df.drop(columns=['text'])
+    joined = build_texts(df)
+    texts = joined.to_pylist()
+
+    # Group similar-length texts into the same batch to minimise padding;
+    # word count is a cheap proxy for token count.
+    lengths = pc.list_value_length(pc.utf8_split_whitespace(joined)).to_numpy()
+    order = np.argsort(lengths, kind='stable')
+    sorted_texts = TextDataset([texts[i] for i in order])
+
+    # Stream batches through the DataLoader so tokenization overlaps the forward passes.
+    # Its forked workers only tokenize on CPU and never touch CUDA; TOKENIZERS_PARALLELISM
+    # is disabled at import so the parent's tokenizer threads don't cross the fork.
+    loader = DataLoader(
+        sorted_texts,
+        batch_size=BATCH_SIZE,
+        num_workers=NUM_WORKERS,
+        collate_fn=partial(collate_batch, tokenizer=tokenizer, fixed_shape=torch.cuda.is_available())
+    )
+    id2label = model.config.id2label
+    labels = [None] * len(texts)
+    scores = np.zeros(len(texts), dtype=np.float32)
+    start = 0
+    for encoded, n in loader:
+        label_ids, batch_scores = forward_batch(model, encoded)
+        idx = order[start:start + n]
+        for i, label_id in zip(idx, label_ids[:n]):
+            labels[i] = id2label[int(label_id)]
+        scores[idx] = batch_scores[:n]
+        start += n
+    df['predicted_label'] = labels
+    df['predicted_score'] = scores
+    return df
 
 def load_and_hash_data():
     logger.info(f"Loading CSV: {CSV_FILE_PATH}")
-    df = pd.read_csv(CSV_FILE_PATH)
-    df['row_hash'] = df.apply(hash_row, axis=1)
+    df = pd.read_csv(CSV_FILE_PATH, engine="pyarrow", dtype_backend="pyarrow")
+    df['row_hash'] = hash_rows(df)
     logger.info(f"Loaded {len(df)} total rows.")
     return df
 
-def get_existing_hashes(engine):
-    logger.info("Fetching existing hashes...")
-    with engine.connect() as conn:
-        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {HASH_TABLE} (hash TEXT PRIMARY KEY);"))
-        result = conn.execute(text(f"SELECT hash FROM {HASH_TABLE};"))
-        return set(row[0] for row in result)
+def copy_to_table(df, table_name, dbapi_conn):
+    # COPY streams the rows as CSV, skipping per-row parameter binding entirely
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    columns = ', '.join(f'"{c}"' for c in df.columns)
+    cur = dbapi_conn.cursor()
+    cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH CSV", buf)
+
+def write_table(df, table_name, conn):
+    # copy_expert is psycopg2-specific; other Postgres drivers take the to_sql path
+    if conn.dialect.driver == 'psycopg2':
+        copy_to_table(df, table_name, conn.connection)
+    else:
+        # Multi-row INSERTs in fixed-size chunks keep memory flat and cut round-trips
+        df.to_sql(
+            table_name, conn, if_exists='append', index=False,
+            chunksize=UPLOAD_CHUNK_SIZE, method='multi'
+        )
+
+def ensure_hash_table(conn):
+    # Older runs stored hex digests in a TEXT column; those can't be compared with
+    # BIGINT hashes, and the table is rewritten every run, so recreate it.
+    if conn.dialect.name == 'postgresql':
+        data_type = conn.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'hash';"
+        ), {"table": HASH_TABLE}).scalar()
+        if data_type == 'text':
+            logger.info(f"Migrating {HASH_TABLE}.hash from TEXT to BIGINT...")
+            conn.execute(text(f"DROP TABLE {HASH_TABLE};"))
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {HASH_TABLE} (hash BIGINT PRIMARY KEY);"))
+
+def get_new_hashes(hashes, engine):
+    # Anti-join on the server so the existing hash set never crosses the network
+    logger.info("Finding new row hashes...")
+    df_stage = pd.DataFrame({'hash': hashes})
+    with engine.begin() as conn:
+        ensure_hash_table(conn)
+        conn.execute(text(f"CREATE TEMPORARY TABLE {STAGE_TABLE} (hash BIGINT);"))
+        write_table(df_stage, STAGE_TABLE, conn)
+        result = conn.execute(text(
+            f"SELECT DISTINCT s.hash FROM {STAGE_TABLE} s "
+            f"LEFT JOIN {HASH_TABLE} h ON s.hash = h.hash "
+            f"WHERE h.hash IS NULL;"
+        ))
+        new_hashes = np.fromiter((int(row[0]) for row in result), dtype=np.int64)
+        conn.execute(text(f"DROP TABLE {STAGE_TABLE};"))
+    return new_hashes
 
 def upload_new_rows(df_new, engine):
     logger.info(f"Overwriting data in tables: {TABLE_NAME} and {HASH_TABLE}...")
 
+    df_to_upload = df_new.drop(columns=['row_hash'])
+    # Identical CSV rows share a hash; the hash table keeps one entry per row content
+    df_hashes = df_new[['row_hash']].drop_duplicates().rename(columns={'row_hash': 'hash'})
+
+    # One transaction, so a failed write leaves the previous contents and version in place
     with engine.begin() as conn:
         conn.execute(text(f"DELETE FROM {TABLE_NAME};"))
         conn.execute(text(f"DELETE FROM {HASH_TABLE};"))
-
-    df_to_upload = df_new.drop(columns=['row_hash'])
-
-    df_to_upload.to_sql(TABLE_NAME, engine, if_exists='append', index=False)
-    pd.DataFrame(df_new['row_hash'], columns=['hash']).to_sql(HASH_TABLE, engine, if_exists='append', index=False)
+        write_table(df_to_upload, TABLE_NAME, conn)
+        write_table(df_hashes, HASH_TABLE, conn)
+        record_upload_time(conn)
 
     logger.info(f"Overwrote {len(df_new)} rows in both tables.")
 
+def record_upload_time(conn):
+    # The backend compares this timestamp to decide whether its cached payload is stale
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {META_TABLE} (id INTEGER PRIMARY KEY, updated_at TIMESTAMP NOT NULL);"))
+    conn.execute(text(f"DELETE FROM {META_TABLE};"))
+    conn.execute(text(f"INSERT INTO {META_TABLE} (id, updated_at) VALUES (1, :updated_at);"), {"updated_at": datetime.now()})
+
 def main():
     start_time = time.time()
     logger.info("Starting daily uploader...")
 
     try:
         engine = create_engine(DATABASE_URL)
-        pipeline = load_pipeline()
 
+        # Hash and dedup first: the hashing pool forks before any CUDA/model state exists,
+        # and the model is only loaded when there are new rows
         df = load_and_hash_data()
-        existing_hashes = get_existing_hashes(engine)
-        df_new = df[~df['row_hash'].isin(existing_hashes)]
+        new_hashes = get_new_hashes(df['row_hash'].to_numpy(), engine)
+        df_new = df[np.isin(df['row_hash'].to_numpy(), new_hashes)]
 
         logger.info(f"Identified {len(df_new)} new rows for processing.")
 
         if not df_new.empty:
-            df_new = add_predictions(df_new, pipeline)
+            model, tokenizer = load_classifier()
+            df_new = add_predictions(df_new, model, tokenizer)
 
         upload_new_rows(df_new, engine)
 
@@ -5,9 +5,8 @@ import urllib3
 import requests
 import pandas as pd
 import asyncio
-from concurrent.futures import ProcessPoolExecutor
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 import dotenv
 
 # ——— Logging setup —————————————————————————————————————————————
@@ -25,6 +24,9 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 dotenv.load_dotenv()
 RESOURCE_ID   = "1d15a62f-5656-49ad-8c88-f40ce689d831"
 CKAN_API_BASE = "https://open.canada.ca/data/api/3/action/"
+MAX_CONCURRENT_REQUESTS = 50
+REQUEST_INTERVAL = 60/2000   # seconds between request starts (2000 RPM budget)
+MAX_RETRIES = 5
 CATEGORIES    = [
     "Housing & Shelter",
     "Education & Training",
@@ -57,15 +59,27 @@ def fetch_csv_via_requests(url: str) -> pd.DataFrame:
     resp = requests.get(url, verify=False)
     resp.raise_for_status()
     logger.info("Download complete, parsing into DataFrame")
-    return pd.read_csv(io.StringIO(resp.text))
-
-def categorize_grant(title: str, description: str) -> str:
+    # Same Arrow-backed dtypes as the cached Parquet path
+    return pd.read_csv(io.BytesIO(resp.content), engine="pyarrow", dtype_backend="pyarrow")
+
+class RequestSpacer:
+    # Spaces request starts at least `interval` seconds apart across all coroutines
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            if self.next_start > now:
+                await asyncio.sleep(self.next_start - now)
+                now = self.next_start
+            self.next_start = now + self.interval
+
+async def categorize_grant(client: genai.Client, sem: asyncio.Semaphore, spacer: RequestSpacer, title: str, description: str) -> str:
     logger.debug("Categorizing grant: %.50s…", title)
     try:
-        client = genai.Client(
-            api_key=os.getenv("GEMINI_API_KEY"),
-        )
-
         model = "gemini-2.0-flash"
         contents = [
             types.Content(
@@ -84,10 +98,6 @@ def categorize_grant(title: str, description: str) -> str:
             ),
         ]
 
-        # add delay to avoid rate limiting
-        import time
-        time.sleep(60/2000)
-
         generate_content_config = types.GenerateContentConfig(
             response_mime_type="text/plain",
             system_instruction=[
@@ -95,15 +105,26 @@ def categorize_grant(title: str, description: str) -> str:
             ],
         )
 
-        resp = ""
-
-        # Stream the response from the model
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            resp += chunk.text
+        async with sem:
+            for attempt in range(MAX_RETRIES + 1):
+                # stay within the request-rate budget
+                await spacer.wait()
+                resp = ""
+                try:
+                    # Stream the response from the model
+                    async for chunk in await client.aio.models.generate_content_stream(
+                        model=model,
+                        contents=contents,
+                        config=generate_content_config,
+                    ):
+                        resp += chunk.text
+                    break
+                except errors.APIError as e:
+                    if e.code != 429 or attempt == MAX_RETRIES:
+                        raise
+                    backoff = 2 ** attempt
+                    logger.warning("Rate limited on '%.50s'; retrying in %ds", title, backoff)
+                    await asyncio.sleep(backoff)
 
         print(f"Categorized grant '{title}' as: {resp.strip()}")
         return resp
@@ -116,47 +137,52 @@ def categorize_grant(title: str, description: str) -> str:
         return "Uncategorized"
 
 async def main():
-    raw_csv_path = "raw_grants_data.csv"
+    raw_parquet_path = "raw_grants_data.parquet"
 
-    # 1. Fetch or load raw CSV
-    if not os.path.exists(raw_csv_path):
+    # 1–2. Load the cleaned grants, or fetch, clean & cache them as Parquet
+    if os.path.exists(raw_parquet_path):
+        logger.info("Loading cleaned grants from %s", raw_parquet_path)
+        df = pd.read_parquet(raw_parquet_path, dtype_backend="pyarrow")
+    else:
         url = get_csv_url_from_resource(RESOURCE_ID)
         df = fetch_csv_via_requests(url)
-        df.to_csv(raw_csv_path, index=False)
-        logger.info("Raw CSV saved to %s", raw_csv_path)
-    else:
-        logger.info("Loading raw CSV from %s", raw_csv_path)
-        df = pd.read_csv(raw_csv_path)
-
-    # 2. Clean & select
-    df = df.rename(columns={
-        'prog_name_en':        'title',
-        'agreement_title_en':  'agreement_title',
-        'description_en':      'description',
-        'recipient_legal_name':'recipient',
-        'agreement_value':     'value'
-    })[['title','agreement_title','description','recipient','value']]
+        df = df.rename(columns={
+            'prog_name_en':        'title',
+            'agreement_title_en':  'agreement_title',
+            'description_en':      'description',
+            'recipient_legal_name':'recipient',
+            'agreement_value':     'value'
+        })[['title','agreement_title','description','recipient','value']]
+        df.to_parquet(raw_parquet_path, index=False, compression="zstd")
+        logger.info("Cleaned grants saved to %s", raw_parquet_path)
     logger.info("DataFrame cleaned; %d rows × %d columns", *df.shape)
 
     # 3. Sample
     sample = df.sample(n=100_000, random_state=42).reset_index(drop=True)
     logger.info("Sampled %d rows", len(sample))
 
-    # 4. Parallel categorize
-    loop = asyncio.get_running_loop()
-    with ProcessPoolExecutor() as pool:
-        logger.info("Starting categorization with %d workers", pool._max_workers)
-        tasks = [
-            loop.run_in_executor(pool, categorize_grant, title, desc)
-            for title, desc in sample[['title','description']].itertuples(index=False, name=None)
-        ]
-        categories = await asyncio.gather(*tasks)
-
-    sample['category'] = categories
+    # Program titles repeat heavily, so only ask the model about each distinct pair once
+    unique = sample[['title','description']].drop_duplicates().reset_index(drop=True)
+    logger.info("%d unique (title, description) pairs to categorize", len(unique))
+
+    # 4. Concurrent categorize (I/O-bound, so coroutines rather than processes)
+    client = genai.Client(
+        api_key=os.getenv("GEMINI_API_KEY"),
+    )
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    spacer = RequestSpacer(REQUEST_INTERVAL)
+    logger.info("Starting categorization with %d concurrent requests", MAX_CONCURRENT_REQUESTS)
+    tasks = [
+        categorize_grant(client, sem, spacer, title, desc)
+        for title, desc in unique.itertuples(index=False, name=None)
+    ]
+    categories = await asyncio.gather(*tasks)
+
+    sample = sample.merge(unique.assign(category=categories), on=['title','description'], how='left')
 
     # 5. Save
-    output_file = "categorized_grants_sample.csv"
-    sample.to_csv(output_file, index=False)
+    output_file = "categorized_grants_sample.parquet"
+    sample.to_parquet(output_file, index=False, compression="zstd")
     logger.info("Categorized sample written to %s", output_file)
 
 if __name__ == "__main__":
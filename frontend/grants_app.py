@@ -1,4 +1,5 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import requests
 
@@ -29,7 +30,11 @@ if "predicted_label" in df.columns:
 # --- Text search ---
 text_filter = st.sidebar.text_input("Search in any column")
 if text_filter:
-    df = df[df.apply(lambda row: row.astype(str).str.contains(text_filter, case=False).any(), axis=1)]
+    # Loop over the (few) columns rather than the rows; regex=False takes the plain substring path
+    mask = np.zeros(len(df), dtype=bool)
+    for col in df.columns:
+        mask |= df[col].astype(str).str.contains(text_filter, case=False, na=False, regex=False).to_numpy()
+    df = df[mask]
 
 # Display table
 st.dataframe(df, use_container_width=True)
@@ -1,7 +1,8 @@
 import os
 import torch
 import pandas as pd
-from datasets import Dataset
+import pyarrow as pa
+import pyarrow.compute as pc
 from transformers import (
     AutoTokenizer,
     AutoModelForSequenceClassification,
@@ -14,11 +15,9 @@ MODEL_DIR = "./classifier"                # path to model dir (with safetensors)
 TEXT_COLUMNS = ['Recipient', 'Agreement', 'Description']  # columns to combine
 
 # === Load CSV (first 100 rows) ===
-df = pd.read_csv(CSV_PATH)
-df['text'] = df[TEXT_COLUMNS].fillna('').astype(str).agg(' '.join, axis=1)
-
-# Create Hugging Face Dataset
-hf_dataset = Dataset.from_pandas(df[['text']])
+df = pd.read_csv(CSV_PATH, engine="pyarrow", dtype_backend="pyarrow")
+text_parts = [pc.fill_null(pc.cast(pa.array(df[c]), pa.string()), '') for c in TEXT_COLUMNS]
+df['text'] = pd.Series(pc.binary_join_element_wise(*text_parts, ' '), dtype=pd.ArrowDtype(pa.string()))
 
 # === Load tokenizer & model ===
 tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR)
@@ -48,9 +47,9 @@ model.config.id2label = id2label
 model.config.label2id = label2id
 
 # === Run inference ===
-texts = [str(x) for x in hf_dataset['text']]
-results = pipeline(texts)
+texts = df['text'].tolist()
+results = pipeline(texts, batch_size=32)
 
 # === Display results ===
-for i, (text, res) in enumerate(zip(hf_dataset['text'], results)):
+for i, (text, res) in enumerate(zip(texts, results)):
     print(f"{i+1:03}: {res['label']} ({res['score']:.4f}) — {text[:60]}...")
\ No newline at end of file
@@ -22,7 +22,10 @@ logging.basicConfig(
 
 def load_and_prepare_data(csv_path):
     logging.info(f"Loading data from {csv_path}")
-    df = pd.read_csv(csv_path)
+    if csv_path.endswith('.parquet'):
+        df = pd.read_parquet(csv_path)
+    else:
+        df = pd.read_csv(csv_path)
     assert 'category' in df.columns, "CSV must contain a 'category' column"
 
     CATEGORIES = [
@@ -77,7 +80,7 @@ def tokenize_and_encode(dataset, tokenizer):
     return dataset.map(fn, batched=True)
 
 def main():
-    DATA_PATH = os.getenv('GRANT_CSV_PATH', 'categorized_grants_sample.csv')
+    DATA_PATH = os.getenv('GRANT_CSV_PATH', 'categorized_grants_sample.parquet')
     MODEL_NAME = 'bert-base-uncased'
     OUTPUT_DIR = './grant_classifier'
     NUM_EPOCHS = 1